@@ -10,7 +10,6 @@ from __future__ import absolute_import
 from __future__ import print_function
 import sys
 import os
-import tarfile 
 
 
 class FileSection(object):
@@ -42,6 +41,11 @@ class FileSection(object):
 
     def read(self, size = -1):
 #        print("read(%d)" % size)
+        # Never read past the end of the section, so that consumers see an
+        # end of file there instead of the following archive members
+        remaining = max(self.offset + self.size - self.f.tell(), 0)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
         return self.f.read(size)
 
 class ArFile(object):
@@ -110,6 +114,8 @@ class ArFile(object):
 
 
 if __name__ == "__main__":
+    import tarfile
+
     if None:
         fn = sys.argv[1]
         f = open(fn, "rb")
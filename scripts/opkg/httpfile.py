@@ -0,0 +1,213 @@
+# SPDX-License-Identifier: GPL-2.0-only
+"""
+httpfile - Read-only file objects for remote files, backed by HTTP range
+requests.
+
+Only the blocks that are actually read are downloaded, so the control
+metadata of a remote package can be read without fetching the whole
+archive: ArFile seeks straight to the control.tar.gz member of ar-format
+packages, and the tar-format packages made by package-build are streamed
+up to their control.tar.gz member, which comes first. Sequential reads,
+such as checksumming or listing a whole package, grow their read-ahead
+window instead, and all requests share one kept-alive connection.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys
+import collections
+import http.client
+import urllib.error
+import urllib.parse
+
+
+class HTTPRangeFile(object):
+    "A seekable read-only file object which fetches a remote file in blocks."
+
+    def __init__(self, url, block_size=16384, max_blocks=64):
+        self.url = url
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.blocks = collections.OrderedDict()
+        self.fetched = 0
+        self.requests = 0
+        self.pos = 0
+        self.size = None
+        self.connection = None
+        # Sequential reads fetch a window of blocks which doubles on each
+        # request, up to the size of the cache
+        self.window = 1
+        # The first block also tells us the total size of the file
+        self._fetch(0, 0)
+        self.next_block = 1
+
+    def _request(self, headers):
+        """Send a GET request over the kept-alive connection, following
+        redirects, and return the response."""
+        for _ in range(5):
+            url = urllib.parse.urlsplit(self.url)
+            path = url.path or "/"
+            if url.query:
+                path += "?" + url.query
+            for retry in (True, False):
+                if self.connection is None:
+                    if url.scheme == "https":
+                        self.connection = http.client.HTTPSConnection(url.netloc)
+                    else:
+                        self.connection = http.client.HTTPConnection(url.netloc)
+                try:
+                    self.connection.request("GET", path, headers=headers)
+                    response = self.connection.getresponse()
+                    break
+                except (http.client.HTTPException, OSError):
+                    # The server may have dropped the idle connection, so
+                    # retry once on a new one
+                    self.close()
+                    if not retry:
+                        raise
+            self.requests += 1
+            if response.status not in (301, 302, 303, 307, 308):
+                return response
+            response.read()
+            self.url = urllib.parse.urljoin(self.url, response.headers["Location"])
+            self.close()
+        raise urllib.error.HTTPError(self.url, response.status,
+                                     "Too many redirects", response.headers, None)
+
+    def _fetch(self, first, last, ranged=True):
+        """Download blocks first to last (inclusive) in a single request and
+        return them."""
+        start = first * self.block_size
+        end = (last + 1) * self.block_size - 1
+        headers = {"Range": "bytes=%d-%d" % (start, end)} if ranged else {}
+        response = self._request(headers)
+        data = response.read()
+        if response.status == 416:
+            # Range not satisfiable: the file is empty
+            self.size = 0
+            return []
+        if response.status not in (200, 206):
+            raise urllib.error.HTTPError(self.url, response.status,
+                                         response.reason, response.headers, None)
+        self.fetched += len(data)
+        if response.status == 206:
+            total = response.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+            if not total.isdigit():
+                # The server does not know the total size (bytes a-b/*), so
+                # the end of the file cannot be found: fetch all of it
+                return self._fetch(first, last, ranged=False)
+            self.size = int(total)
+            offset = start
+        else:
+            # The server ignored the Range header and sent the whole
+            # file, keep all of it since it has been downloaded anyway
+            self.size = len(data)
+            self.max_blocks = None
+            offset = 0
+
+        for pos in range(0, len(data), self.block_size):
+            index = (offset + pos) // self.block_size
+            self.blocks[index] = data[pos:pos + self.block_size]
+            self.blocks.move_to_end(index)
+        blocks = [self.blocks[index] for index in range(first, last + 1)
+                  if index in self.blocks]
+        if self.max_blocks:
+            while len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+        return blocks
+
+    def _load(self, first, last):
+        """Return blocks first to last, fetching each run of missing blocks
+        with one request. A run which continues the previous request is
+        extended by the read-ahead window."""
+        blocks = []
+        index = first
+        while index <= last:
+            block = self.blocks.get(index)
+            if block is not None:
+                self.blocks.move_to_end(index)
+                blocks.append(block)
+                index += 1
+                continue
+            run_end = index
+            while run_end < last and run_end + 1 not in self.blocks:
+                run_end += 1
+            if index == self.next_block:
+                self.window = min(self.window * 2, self.max_blocks or self.window)
+            else:
+                self.window = 1
+            fetch_end = max(run_end, index + self.window - 1)
+            if self.size:
+                fetch_end = min(fetch_end, (self.size - 1) // self.block_size)
+            blocks.extend(self._fetch(index, fetch_end)[:run_end - index + 1])
+            self.next_block = fetch_end + 1
+            index = run_end + 1
+        return blocks
+
+    def seek(self, offset, whence = 0):
+        if whence == 0:
+            self.pos = offset
+        elif whence == 1:
+            self.pos += offset
+        elif whence == 2:
+            self.pos = self.size + offset
+        else:
+            assert False
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size = -1):
+        end = self.size if size is None or size < 0 else min(self.pos + size, self.size)
+        if end <= self.pos:
+            return b""
+        first = self.pos // self.block_size
+        last = (end - 1) // self.block_size
+        data = b"".join(self._load(first, last))
+        offset = first * self.block_size
+        data = data[self.pos - offset:end - offset]
+        self.pos += len(data)
+        return data
+
+    def readline(self, size = -1):
+        line = b""
+        while self.pos < self.size and (size is None or size < 0 or len(line) < size):
+            index = self.pos // self.block_size
+            block = self._load(index, index)[0]
+            start = self.pos - index * self.block_size
+            stop = block.find(b"\n", start)
+            stop = len(block) if stop == -1 else stop + 1
+            if size is not None and size >= 0:
+                stop = min(stop, start + size - len(line))
+            line += block[start:stop]
+            self.pos += stop - start
+            if line.endswith(b"\n"):
+                break
+        return line
+
+    def close(self):
+        # Only the connection is released: the block cache stays valid, and
+        # a later read opens a new connection if it needs more blocks
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    import opkg
+
+    for url in sys.argv[1:]:
+        pkg = opkg.Package(url)
+        sys.stdout.write(pkg.print([]))
+        sys.stderr.write("%s: fetched %d of %d bytes in %d requests\n"
+                         % (url, pkg.remote_file.fetched, pkg.size,
+                            pkg.remote_file.requests))
@@ -35,18 +35,16 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-import tempfile
+# Only modules needed to parse control files, compare versions and read
+# package indexes are imported here. Modules needed to open package archives,
+# hash them, fetch them or run commands are imported where they are used, so
+# that tools which only query indexes start quickly.
 import os
 import sys
-import glob
-import hashlib
 import re
-import subprocess
 from stat import ST_SIZE
-import arfile
-import tarfile
-import textwrap
 import collections
+import functools
 
 
 def order(x):
@@ -145,6 +143,22 @@ def parse_version(versionstr):
         epoch = int(epochstr)
     return Version(epoch, versionstr)
 
+def is_remote(fn):
+    """Whether a package path is an HTTP(S) URL rather than a local file."""
+    return re.match(r"https?://", fn) is not None
+
+def parse_relation_names(relations):
+    """Return the package names referenced by a relationship field such as
+    Depends or Conflicts, ignoring version constraints and alternatives."""
+    if not relations:
+        return []
+    names = []
+    for relation in re.split(r"[,|]", relations):
+        name = re.sub(r"\(.*?\)", "", relation).strip().split(":")[0]
+        if name:
+            names.append(name)
+    return names
+
 class Package(object):
     """A class for creating objects to manipulate (e.g. create) opkg
        packages."""
@@ -182,22 +196,34 @@ class Package(object):
         self.tags = None
         self.fn = fn
         self.license = None
+        # file object used to read fn when it is a remote URL
+        self.remote_file = None
 
         self.user_defined_fields = collections.OrderedDict()
         if fn:
+            import arfile
+            import tarfile
+
             # see if it is deb format
-            f = open(fn, "rb")
+            f = self._open()
 
-            if relpath:
+            if relpath and not self.remote_file:
                 self.filename = os.path.relpath(fn, relpath)
             else:
                 self.filename = os.path.basename(fn)
 
             ## sys.stderr.write("  extracting control.tar.gz from %s\n"% (fn,)) 
 
-            if tarfile.is_tarfile(fn):
-                tar = tarfile.open(fn, "r", f)
-                tarStream = tar.extractfile("./control.tar.gz")
+            if self._is_tar_format(f):
+                if self.remote_file:
+                    # package-build stores control.tar.gz first, so
+                    # streaming stops after fetching the first blocks
+                    import io
+                    tarStream = io.BytesIO(
+                        self._stream_member(f, "control.tar.gz").read())
+                else:
+                    tar = tarfile.open(fn, "r", f)
+                    tarStream = tar.extractfile("./control.tar.gz")
             else:
                 ar = arfile.ArFile(f, fn)
                 tarStream = ar.open("control.tar.gz")
@@ -227,12 +253,46 @@ class Package(object):
         else:
             raise AttributeError(name)
 
+    def _open(self):
+        """Open the package file, fetching it by ranges if it is remote."""
+        if not is_remote(self.fn):
+            return open(self.fn, "rb")
+        if not self.remote_file:
+            import httpfile
+            self.remote_file = httpfile.HTTPRangeFile(self.fn)
+        self.remote_file.seek(0)
+        return self.remote_file
+
+    def _is_tar_format(self, f):
+        """Whether the package is a plain tar archive, as made by
+        package-build, rather than an ar archive."""
+        if not self.remote_file:
+            import tarfile
+            return tarfile.is_tarfile(self.fn)
+        # Only check the ar magic so as not to fetch the whole remote file
+        is_tar = f.read(8) != b"!<arch>\n"
+        f.seek(0)
+        return is_tar
+
+    def _stream_member(self, f, *names):
+        """Read a tar-format package sequentially up to the first of the
+        given members and return a stream of its contents. Unlike random
+        access, this never goes back to blocks that were already read,
+        which matters when f is fetched remotely."""
+        import tarfile
+        tar = tarfile.open(fileobj=f, mode="r|*")
+        for member in tar:
+            if os.path.normpath(member.name) in names:
+                return tar.extractfile(member)
+        raise KeyError("no member %s in %s" % (" or ".join(names), self.fn))
+
     def _computeFileMD5(self):
         # compute the MD5.
         if not self.fn:
             self.md5 = 'Unknown'
         else:
-            f = open(self.fn, "rb")
+            import hashlib
+            f = self._open()
             sum = hashlib.md5()
             while True:
                data = f.read(1024)
@@ -246,7 +306,8 @@ class Package(object):
         if not self.fn:
             self.sha256 = 'Unknown'
         else:
-            f = open(self.fn, "rb")
+            import hashlib
+            f = self._open()
             sum = hashlib.sha256()
             while True:
                data = f.read(1024)
@@ -258,6 +319,8 @@ class Package(object):
     def _get_file_size(self):
         if not self.fn:
             self.size = 0;
+        elif is_remote(self.fn):
+            self.size = self._open().size
         else:
             stat = os.stat(self.fn)
             self.size = stat[ST_SIZE]
@@ -305,6 +368,8 @@ class Package(object):
         return    
 
     def _setup_scratch_area(self):
+        import tempfile
+
         self.scratch_dir = "%s/%sopkg" % (tempfile.gettempdir(),
                                            tempfile.gettempprefix())
         self.file_dir = "%s/files" % (self.scratch_dir)
@@ -393,7 +458,9 @@ class Package(object):
     def get_license(self, license):
         return self.license
 
-    def get_file_list_dir(self, directory):
+    def get_file_list_dir(self, directory, include_dirs=True):
+        import subprocess
+
         def check_output(*popenargs, **kwargs):
             """Run command with arguments and return its output as a byte string.
 
@@ -427,22 +494,40 @@ class Package(object):
                 sys.stderr.write("Cannot find current fn for package '%s' filename '%s' in dir '%s'\n(%s)\n" % (self.package, self.filename, directory, e))
             except IOError as e:
                 sys.stderr.write("Cannot find current fn for package '%s' filename '%s' in dir '%s'\n(%s)\n" % (self.package, self.filename, directory, e))
-        return self.get_file_list()
+        return self.get_file_list(include_dirs)
 
 
-    def get_file_list(self):
+    def get_file_list(self, include_dirs=True):
         if not self.fn:
             sys.stderr.write("Package '%s' has empty fn, returning empty filelist\n" % (self.package))
             return []
-        f = open(self.fn, "rb")
-        ar = arfile.ArFile(f, self.fn)
-        try:
-            tarStream = ar.open("data.tar.gz")
-            tarf = tarfile.open("data.tar.gz", "r", tarStream)
-        except IOError:
-            tarStream = ar.open("data.tar.xz")
-            tarf = tarfile.open("data.tar.xz", "r:xz", tarStream)
-        self.file_list = tarf.getnames()
+        import arfile
+        import tarfile
+
+        f = self._open()
+        if self._is_tar_format(f) and self.remote_file:
+            tarStream = self._stream_member(f, "data.tar.gz", "data.tar.xz")
+            tarf = tarfile.open(fileobj=tarStream, mode="r|*")
+        elif self._is_tar_format(f):
+            tar = tarfile.open(self.fn, "r", f)
+            try:
+                tarStream = tar.extractfile("./data.tar.gz")
+                tarf = tarfile.open("data.tar.gz", "r", tarStream)
+            except KeyError:
+                tarStream = tar.extractfile("./data.tar.xz")
+                tarf = tarfile.open("data.tar.xz", "r:xz", tarStream)
+        else:
+            ar = arfile.ArFile(f, self.fn)
+            try:
+                tarStream = ar.open("data.tar.gz")
+                tarf = tarfile.open("data.tar.gz", "r", tarStream)
+            except IOError:
+                tarStream = ar.open("data.tar.xz")
+                tarf = tarfile.open("data.tar.xz", "r:xz", tarStream)
+        if include_dirs:
+            self.file_list = tarf.getnames()
+        else:
+            self.file_list = [m.name for m in tarf.getmembers() if not m.isdir()]
         self.file_list = [["./", ""][a.startswith("./")] + a for a in self.file_list]
 
         f.close()
@@ -613,6 +698,292 @@ class Packages(object):
     def __getitem__(self, key):
         return self.packages[key]
 
+def plan_retention(entries, keep=1, since=None):
+    """Select the packages to archive under a retention policy.
+
+    entries is a sequence of (pkg, mtime) pairs. They are grouped by
+    (name, architecture) and each group is sorted once by version, ties
+    being broken in favour of later entries. In each group, the newest keep
+    packages and those with an mtime at or after since are retained. Returns
+    the entries to archive, in the order they were given."""
+    groups = collections.OrderedDict()
+    for position, (pkg, mtime) in enumerate(entries):
+        groups.setdefault((pkg.package, pkg.architecture), []).append(
+            (position, pkg, mtime))
+
+    def compare(first, second):
+        return first[1].compare_version(second[1]) or first[0] - second[0]
+
+    archived = []
+    for group in groups.values():
+        group.sort(key=functools.cmp_to_key(compare), reverse=True)
+        for rank, (position, pkg, mtime) in enumerate(group):
+            if rank < keep:
+                continue
+            if since is not None and mtime >= since:
+                continue
+            archived.append((position, pkg, mtime))
+    archived.sort(key=lambda entry: entry[0])
+    return [(pkg, mtime) for _, pkg, mtime in archived]
+
+UpgradePlan = collections.namedtuple("UpgradePlan", "upgrade downgrade orphan")
+
+class UpgradePlanner(object):
+    """Evaluate installed package sets against a feed index.
+
+    The feed is reduced once to the newest version of each package name and
+    architecture, the same way Packages.add_package keys packages. Verdicts
+    are memoized per (name, architecture, installed version), so evaluating
+    many devices that share the same installed versions only compares each
+    distinct triple once."""
+    def __init__(self, feed):
+        self.newest = {}
+        self._verdicts = {}
+        for key in feed.keys():
+            pkg = feed[key]
+            if not pkg.parsed_version:
+                pkg.parsed_version = parse_version(pkg.version)
+            newest_key = (pkg.package, pkg.architecture)
+            current = self.newest.get(newest_key)
+            if current is None or pkg.compare_version(current) > 0:
+                self.newest[newest_key] = pkg
+
+    def _verdict(self, newest_key, version):
+        key = newest_key + (version,)
+        verdict = self._verdicts.get(key)
+        if verdict is None:
+            ref = self.newest[newest_key].parsed_version
+            verdict = ref.compare(parse_version(version))
+            self._verdicts[key] = verdict
+        return verdict
+
+    def _read_status(self, path):
+        """Yield the packages of an opkg status file. Unlike
+        Packages.read_packages_file, this neither parses nor compares
+        versions, which only matters for the verdicts not memoized yet."""
+        with open(path, "r") as f:
+            while True:
+                pkg = Package()
+                pkg.read_control(f, all_fields=True)
+                if not pkg.get_package():
+                    break
+                yield pkg
+
+    def plan(self, status):
+        """Compute the upgrade plan for one installed package set.
+
+        status is either a Packages object or the path to an opkg status
+        file. Returns an UpgradePlan whose members are keyed by (name,
+        architecture), like the feed: upgrade and downgrade map them to
+        (installed version, feed version) pairs, and orphan maps those
+        missing from the feed to their installed version."""
+        if isinstance(status, Packages):
+            installed = [status[key] for key in status.keys()]
+        else:
+            installed = self._read_status(status)
+        upgrade = {}
+        downgrade = {}
+        orphan = {}
+        for pkg in installed:
+            state = pkg.user_defined_fields.get("Status")
+            if state and state.split()[-1] != "installed":
+                continue
+            newest_key = (pkg.package, pkg.architecture)
+            if newest_key not in self.newest:
+                orphan[newest_key] = pkg.version
+                continue
+            verdict = self._verdict(newest_key, pkg.version)
+            if verdict > 0:
+                upgrade[newest_key] = (pkg.version, self.newest[newest_key].version)
+            elif verdict < 0:
+                downgrade[newest_key] = (pkg.version, self.newest[newest_key].version)
+        return UpgradePlan(upgrade, downgrade, orphan)
+
+class PathIndex(object):
+    """An inverted index from installed file paths to the packages that
+    install them.
+
+    Paths are stored as tuples of interned components, so the directory
+    prefixes shared by most files of a feed are only kept once in memory."""
+    def __init__(self):
+        self.owners = {}
+        self.packages = {}
+
+    def add_package(self, pkg, file_list):
+        name = pkg.package
+        self.packages[name] = pkg
+        for path in file_list:
+            key = tuple(sys.intern(part) for part in path.split("/")
+                        if part and part != ".")
+            if not key:
+                continue
+            owners = self.owners.get(key)
+            if owners is None:
+                self.owners[key] = [name]
+            elif name not in owners:
+                owners.append(name)
+
+    def _may_overlap(self, name, ref):
+        """Whether name and ref are allowed to install the same path, that
+        is, one of them conflicts with or replaces the other."""
+        for first, second in ((name, ref), (ref, name)):
+            pkg = self.packages[first]
+            other = self.packages[second]
+            provided = set([second] + parse_relation_names(other.provides))
+            related = (parse_relation_names(pkg.conflicts)
+                       + parse_relation_names(pkg.replaces))
+            if provided.intersection(related):
+                return True
+        return False
+
+    def collisions(self):
+        """Yield (path, owners) for each path installed by at least two
+        packages that neither conflict with nor replace each other, in
+        path order."""
+        for key in sorted(self.owners):
+            owners = self.owners[key]
+            if len(owners) < 2:
+                continue
+            colliding = set()
+            for i, name in enumerate(owners):
+                for ref in owners[i + 1:]:
+                    if not self._may_overlap(name, ref):
+                        colliding.update((name, ref))
+            if colliding:
+                yield "/" + "/".join(key), sorted(colliding)
+
+class Pool(object):
+    """A content-addressed store of package files.
+
+    Each package is stored once as <sha256[:2]>/<sha256><ext>, next to a
+    <sha256>.control file caching its control fields, size and checksums.
+    Feed directories hold hard links into the pool, so identical packages
+    are stored and hashed once and the indexer, which recognises pooled
+    files by inode, can reuse their cached metadata in every feed. The pool
+    must therefore be on the same filesystem as its feeds."""
+    def __init__(self, pool_dir):
+        self.pool_dir = pool_dir
+        self._inodes = None
+
+    def _object_path(self, digest, ext):
+        return os.path.join(self.pool_dir, digest[:2], digest + ext)
+
+    def _scan(self):
+        """Map the inode of each pool object to its SHA256 digest."""
+        self._inodes = {}
+        for dirpath, _, filenames in os.walk(self.pool_dir):
+            for filename in filenames:
+                digest, ext = os.path.splitext(filename)
+                if ext == ".control" or "." in digest:
+                    continue
+                stat = os.stat(os.path.join(dirpath, filename))
+                self._inodes[(stat.st_dev, stat.st_ino)] = digest
+
+    def digest(self, fn):
+        """Return the SHA256 digest of fn if it is linked to a pool object,
+        or None otherwise."""
+        if self._inodes is None:
+            self._scan()
+        stat = os.stat(fn)
+        return self._inodes.get((stat.st_dev, stat.st_ino))
+
+    def add(self, fn):
+        """Store fn in the pool unless an identical package is already there,
+        and return the path of its pool object."""
+        ext = os.path.splitext(fn)[1]
+        digest = self.digest(fn)
+        if digest:
+            return self._object_path(digest, ext)
+
+        import hashlib
+        import shutil
+
+        # Work on a private copy rather than linking fn itself, so that fn
+        # being rewritten in place later cannot alter the pool object
+        if not os.path.exists(self.pool_dir):
+            os.makedirs(self.pool_dir)
+        tmp_path = os.path.join(self.pool_dir, ".%s.%d"
+                                % (os.path.basename(fn), os.getpid()))
+        shutil.copy2(fn, tmp_path)
+        try:
+            md5 = hashlib.md5()
+            sha256 = hashlib.sha256()
+            with open(tmp_path, "rb") as f:
+                while True:
+                    data = f.read(1 << 20)
+                    if not data: break
+                    md5.update(data)
+                    sha256.update(data)
+            digest = sha256.hexdigest()
+            object_path = self._object_path(digest, ext)
+            if os.path.exists(object_path):
+                return object_path
+
+            object_dir = os.path.dirname(object_path)
+            if not os.path.exists(object_dir):
+                os.makedirs(object_dir)
+            pkg = Package(tmp_path, all_fields=True)
+            pkg.md5 = md5.hexdigest()
+            pkg.sha256 = digest
+            pkg.filename = None
+            control_path = os.path.join(object_dir, digest + ".control")
+            tmp_control_path = "%s.%d" % (control_path, os.getpid())
+            with open(tmp_control_path, "w") as control:
+                control.write(pkg.print(['md5', 'sha256']))
+            os.rename(tmp_control_path, control_path)
+            os.rename(tmp_path, object_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        stat = os.stat(object_path)
+        self._inodes[(stat.st_dev, stat.st_ino)] = digest
+        return object_path
+
+    def link(self, fn, feed_dir):
+        """Add fn to the pool and make feed_dir hold a link to its pool
+        object under the same name. Return the paths of the link and of the
+        pool object."""
+        object_path = self.add(fn)
+        dest = os.path.join(feed_dir, os.path.basename(fn))
+        if not (os.path.exists(dest) and os.path.samefile(dest, object_path)):
+            _link(object_path, dest)
+        return dest, object_path
+
+    def lookup(self, fn, relpath=None, all_fields=None):
+        """Return a Package for fn built from the cached metadata of its pool
+        object, or None if fn is not linked to the pool."""
+        digest = self.digest(fn)
+        if not digest:
+            return None
+        pkg = Package()
+        with open(self._object_path(digest, ".control"), "r") as control:
+            pkg.read_control(control, all_fields=True)
+        if not all_fields:
+            pkg.user_defined_fields.clear()
+        pkg.fn = fn
+        if relpath:
+            pkg.filename = os.path.relpath(fn, relpath)
+        else:
+            pkg.filename = os.path.basename(fn)
+        return pkg
+
+def _link(src, dest):
+    """Atomically replace dest with a hard link to src."""
+    import errno
+
+    tmp_dest = "%s.%d" % (dest, os.getpid())
+    try:
+        os.link(src, tmp_dest)
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            # A copy would get its own inode and never be recognised as
+            # pooled, so refuse instead of silently duplicating the package
+            raise OSError(e.errno, "The package pool must be on the same "
+                          "filesystem as the feed", dest)
+        raise
+    os.rename(tmp_dest, dest)
+
 if __name__ == "__main__":
 
     assert Version(0, "1.2.2-r1").compare(Version(0, "1.2.3-r0")) == -1
@@ -622,6 +993,222 @@ if __name__ == "__main__":
     assert Version(0, "1.2.2-r5").compare(Version(0, "1.2.2-r0")) == 1
     assert Version(0, "1.1.2~r1").compare(Version(0, "1.1.2")) == -1
 
+    def make_packages(entries):
+        packages = Packages()
+        for entry in entries:
+            name, version = entry[:2]
+            pkg = Package()
+            pkg.set_package(name)
+            pkg.set_version(version)
+            pkg.set_architecture(entry[2] if len(entry) > 2 else "arm")
+            packages.add_package(pkg)
+        return packages
+
+    planner = UpgradePlanner(make_packages([
+        ("foo", "1.1-r0"), ("foo", "1.2-r0"), ("bar", "2.0-r0"), ("baz", "1:0.1"),
+        ("qux", "1.0", "arm"), ("qux", "3.0", "x86")]))
+    plan = planner.plan(make_packages([
+        ("foo", "1.1-r0"), ("bar", "2.1-r0"), ("baz", "0.2"), ("old", "1.0"),
+        ("qux", "1.0"), ("other", "1.0", "x86")]))
+    assert plan.upgrade == {("foo", "arm"): ("1.1-r0", "1.2-r0"),
+                            ("baz", "arm"): ("0.2", "1:0.1")}
+    assert plan.downgrade == {("bar", "arm"): ("2.1-r0", "2.0-r0")}
+    assert plan.orphan == {("old", "arm"): "1.0", ("other", "x86"): "1.0"}
+
+    # Status files are read without going through Packages, so a package
+    # installed for two architectures is planned once for each
+    import tempfile
+    with tempfile.NamedTemporaryFile("w", suffix=".status") as status:
+        status.write("Package: qux\nVersion: 1.0\nArchitecture: arm\n"
+                     "Status: install ok installed\n\n"
+                     "Package: qux\nVersion: 1.0\nArchitecture: x86\n"
+                     "Status: install ok installed\n\n"
+                     "Package: foo\nVersion: 1.0\nArchitecture: arm\n"
+                     "Status: deinstall ok config-files\n\n")
+        status.flush()
+        plan = planner.plan(status.name)
+    assert plan.upgrade == {("qux", "x86"): ("1.0", "3.0")}
+    assert not plan.downgrade and not plan.orphan
+
+    entries = []
+    for version, mtime in (("1.0-r0", 100), ("1.2-r0", 50), ("1.1-r0", 300), ("0.9-r0", 10)):
+        pkg = Package()
+        pkg.set_package("foo")
+        pkg.set_version(version)
+        pkg.set_architecture("arm")
+        entries.append((pkg, mtime))
+    assert [pkg.version for pkg, _ in plan_retention(entries)] == ["1.0-r0", "1.1-r0", "0.9-r0"]
+    assert [pkg.version for pkg, _ in plan_retention(entries, keep=2)] == ["1.0-r0", "0.9-r0"]
+    assert [pkg.version for pkg, _ in plan_retention(entries, since=100)] == ["0.9-r0"]
+
+    # Parsing, version comparison and index reading are used by tools started
+    # many times per run: importing opkg must not pull in the modules only
+    # needed to open, hash or fetch package archives
+    import subprocess
+
+    # The stdlib modules opkg needs are imported first, so that -X importtime
+    # charges opkg only with its own code and with what it imports on top.
+    # A first run refreshes the bytecode cache, so that compiling opkg is not
+    # counted, and the best of several runs is kept to ignore a loaded machine.
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    def import_time():
+        report = subprocess.check_output(
+            [sys.executable, "-X", "importtime", "-c",
+             "import os, sys, re, stat, collections, functools; import opkg"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            stderr=subprocess.STDOUT, universal_newlines=True)
+        match = re.search(r"^import time:\s*\d+ \|\s*(\d+) \| opkg$", report, re.M)
+        return int(match.group(1))
+    import_time()
+    best = min(import_time() for _ in range(5))
+    assert best < 10000, "importing opkg takes %d us" % best
+
+    modules = subprocess.check_output(
+        [sys.executable, "-c", "import sys, opkg; print(' '.join(sys.modules))"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        universal_newlines=True).split()
+    for heavy in ("tarfile", "hashlib", "subprocess", "tempfile",
+                  "urllib.request", "http.client", "arfile", "httpfile"):
+        assert heavy not in modules, "importing opkg loads " + heavy
+
+    assert parse_relation_names("foo (>= 1.0), bar | baz:any") == ["foo", "bar", "baz"]
+
+    index = PathIndex()
+    for name, conflicts, files in (
+            ("foo", None, ["./opt/bin/foo", "./opt/share/common"]),
+            ("bar", None, ["./opt/bin/bar", "./opt/share/common"]),
+            ("baz", "foo (<< 2.0)", ["./opt/bin/foo"])):
+        pkg = Package()
+        pkg.set_package(name)
+        pkg.set_conflicts(conflicts)
+        index.add_package(pkg, files)
+    assert list(index.collisions()) == [("/opt/share/common", ["bar", "foo"])]
+
+    import hashlib
+    import io
+    import tarfile
+
+    def make_tar_gz(members):
+        """Build a gzipped tar archive from (name, data) pairs, data being
+        None for directories."""
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                if data is None:
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(info)
+                else:
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+        return buf.getvalue()
+
+    def make_package(directory, name, files, ar_format=False, extra=b""):
+        """Write a package with the given data files, in the tar format made
+        by package-build or in the ar format."""
+        control = make_tar_gz([
+            ("./", None),
+            ("./control", b"Package: " + name.encode()
+                + b"\nVersion: 1.0-1\nArchitecture: rmall\n")])
+        data = make_tar_gz([("./", None), ("./opt/", None)]
+                           + [("./" + path, content) for path, content in files])
+        members = [("control.tar.gz", control), ("data.tar.gz", data),
+                   ("debian-binary", b"2.0\n")]
+        fn = os.path.join(directory, name + "_1.0-1_rmall.ipk")
+        with open(fn, "wb") as f:
+            if not ar_format:
+                f.write(make_tar_gz([("./", None)] + [
+                    ("./" + member, content) for member, content in members]))
+                return fn
+            f.write(b"!<arch>\n")
+            for member, content in members:
+                f.write(("%-16s%-12d%-6d%-6d%-8s%-10d`\n" % (
+                    member + "/", 0, 0, 0, "100644", len(content))).encode())
+                f.write(content + b"\n" * (len(content) % 2))
+        return fn
+
+    scratch = tempfile.mkdtemp()
+    index = PathIndex()
+    for name, ar_format in (("foo", False), ("bar", False), ("baz", True)):
+        fn = make_package(scratch, name, [("opt/bin/" + name, b"x"),
+                                          ("opt/share/common", b"x")], ar_format)
+        pkg = Package(fn)
+        assert pkg.package == name
+        index.add_package(pkg, pkg.get_file_list(include_dirs=False))
+    assert list(index.collisions()) == [("/opt/share/common", ["bar", "baz", "foo"])]
+
+    # Read remote packages through a local server which honours Range
+    import http.server
+    import threading
+
+    class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+        # Keep connections alive, and count them along with requests
+        protocol_version = "HTTP/1.1"
+        connections = 0
+        requests = 0
+
+        def setup(self):
+            RangeRequestHandler.connections += 1
+            http.server.SimpleHTTPRequestHandler.setup(self)
+
+        def send_head(self):
+            RangeRequestHandler.requests += 1
+            match = re.match(r"bytes=(\d+)-(\d+)$", self.headers.get("Range", ""))
+            path = self.translate_path(self.path)
+            if not match or not os.path.isfile(path):
+                return http.server.SimpleHTTPRequestHandler.send_head(self)
+            size = os.path.getsize(path)
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1)
+            if start >= size:
+                self.send_error(416)
+                return None
+            with open(path, "rb") as f:
+                f.seek(start)
+                data = f.read(end - start + 1)
+            # Requests ending in ?unknown-size get ranges of unknown length
+            total = "*" if self.path.endswith("?unknown-size") else str(size)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%s" % (start, end, total))
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            return io.BytesIO(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        functools.partial(RangeRequestHandler, directory=scratch))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:%d/" % server.server_address[1]
+    for name, ar_format in (("remote-tar", False), ("remote-ar", True)):
+        fn = make_package(scratch, name, [("opt/pad", os.urandom(1 << 20))], ar_format)
+        pkg = Package(base_url + os.path.basename(fn))
+        assert pkg.package == name and pkg.version == "1.0-1"
+        assert pkg.size == os.path.getsize(fn)
+        assert pkg.remote_file.fetched <= pkg.remote_file.block_size
+
+        # Each full pass over the 1 MB package grows its read-ahead window
+        # instead of sending one request per block, on a single connection
+        RangeRequestHandler.connections = RangeRequestHandler.requests = 0
+        assert "./opt/pad" in pkg.get_file_list()
+        with open(fn, "rb") as f:
+            assert pkg.sha256 == hashlib.sha256(f.read()).hexdigest()
+        assert RangeRequestHandler.requests <= 16, RangeRequestHandler.requests
+        assert RangeRequestHandler.connections <= 2, RangeRequestHandler.connections
+
+    pkg = Package(base_url + os.path.basename(fn) + "?unknown-size")
+    assert pkg.package == "remote-ar" and pkg.size == os.path.getsize(fn)
+    pkg.remote_file.close()
+    server.shutdown()
+    server.server_close()
+
+    import shutil
+    shutil.rmtree(scratch)
+
     package = Package()
 
     package.set_package("FooBar")